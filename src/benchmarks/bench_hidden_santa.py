@@ -0,0 +1,48 @@
+"""
+Times SantaStore.ingest_csv and generate_all_permutations on many synthetic groups, in process and with worker processes.
+
+    cd src && python -m benchmarks.bench_hidden_santa --n-groups 5000 --group-size 20 --max-workers 1 4
+"""
+import argparse
+import io
+import os
+import time
+
+from modules import SantaStore
+
+
+def make_csv(n_groups: int, group_size: int) -> str:
+    lines = []
+    for group_id in range(n_groups):
+        lines += [f"{group_id},user_{group_id}_{i}" for i in range(group_size)]
+        # every member has one forbidden receiver, e.g. partner
+        lines += [f"{group_id},user_{group_id}_{i},user_{group_id}_{(i + 1) % group_size}" for i in range(group_size)]
+    return "\n".join(lines)
+
+
+def run_benchmark(n_groups: int, group_size: int, max_workers: list[int]) -> dict[str, float]:
+    csv = make_csv(n_groups, group_size)
+    store = SantaStore()
+
+    start = time.perf_counter()
+    store.ingest_csv(io.StringIO(csv))
+    results = {"ingest_csv_seconds": time.perf_counter() - start}
+
+    for workers in max_workers:
+        start = time.perf_counter()
+        failed_group_ids = store.generate_all_permutations(seed="bench", max_workers=workers)
+        results[f"generate_all_{workers}_workers_seconds"] = time.perf_counter() - start
+        results[f"generate_all_{workers}_workers_failed"] = len(failed_group_ids)
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n-groups", type=int, default=5000)
+    parser.add_argument("--group-size", type=int, default=20)
+    parser.add_argument("--max-workers", type=int, nargs="+", default=[1, os.cpu_count()])
+    args = parser.parse_args()
+
+    for key, value in run_benchmark(args.n_groups, args.group_size, args.max_workers).items():
+        print(f"{key}: {value:.3f}")
@@ -0,0 +1,66 @@
+"""
+Measures SendQueue throughput and latency (from put to sent) against a fake Bot API with configurable latency.
+
+    cd src && python -m benchmarks.bench_send_queue --n-messages 5000 --n-chats 1000 --global-rate 500
+"""
+import argparse
+import asyncio
+import time
+
+from send_queue import SendQueue
+
+
+async def run_benchmark(
+    n_messages: int,
+    n_chats: int,
+    api_latency: float,
+    n_workers: int,
+    global_rate: float,
+    per_chat_rate: float,
+) -> dict[str, float]:
+    latencies: list[float] = []
+
+    async def send(put_at: float):
+        await asyncio.sleep(api_latency)
+        latencies.append(time.perf_counter() - put_at)
+
+    queue = SendQueue(
+        n_workers=n_workers,
+        global_rate=global_rate,
+        per_chat_rate=per_chat_rate,
+        max_size=n_messages,
+    )
+    await queue.start()
+
+    start = time.perf_counter()
+    for i in range(n_messages):
+        put_at = time.perf_counter()
+        await queue.put(i % n_chats, lambda put_at=put_at: send(put_at))
+    await queue.stop()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "messages_per_second": n_messages / elapsed,
+        "latency_p50_ms": 1000 * latencies[len(latencies) // 2],
+        "latency_p99_ms": 1000 * latencies[int(len(latencies) * 0.99)],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n-messages", type=int, default=2000)
+    parser.add_argument("--n-chats", type=int, default=500)
+    parser.add_argument("--api-latency", type=float, default=0.05)
+    parser.add_argument("--n-workers", type=int, default=32)
+    parser.add_argument("--global-rate", type=float, default=500)
+    parser.add_argument("--per-chat-rate", type=float, default=1)
+    args = parser.parse_args()
+
+    results = asyncio.run(
+        run_benchmark(
+            args.n_messages, args.n_chats, args.api_latency, args.n_workers, args.global_rate, args.per_chat_rate
+        )
+    )
+    for key, value in results.items():
+        print(f"{key}: {value:.2f}")
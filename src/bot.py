@@ -1,13 +1,16 @@
+import asyncio
 import logging
 import os
 import random
+import time
 from enum import Enum
 from textwrap import dedent
 
 import telegram  # noqa https://youtrack.jetbrains.com/issue/PY-60059
 from telegram.ext import ApplicationBuilder, MessageHandler, ContextTypes  # noqa
 
-from modules import NGramTalkModule, SantaModule
+from modules import NGramTalkModule, SantaStore
+from send_queue import GLOBAL_RATE, PER_CHAT_RATE, SendQueue
 
 
 class BotState(Enum):
@@ -16,6 +19,7 @@ class BotState(Enum):
     LEARN_TEXT_WAITING_TEXT = 3
     FORGET_TEXT_WAITING_TEXT_ID = 4
     HIDDEN_SANTA_WAITING_FILE = 5
+    HIDDEN_SANTA_WAITING_CSV = 6
 
 
 class FileManager:
@@ -32,28 +36,78 @@ class FileManager:
 class Bot:
     TMP_TEXT_FILE_NAME: str = "tmp.txt"
     NGRAM_MODULE_SAVE_FILE_NAME: str = "ngram_module_save_file.txt"
+    WEBHOOK_URL_PATH: str = "telegram"
 
     def __init__(self):
+        if self.webhook_local and not self.bot_api_base_url:
+            # otherwise PTB would register our local address as webhook on real Telegram
+            raise ValueError("WEBHOOK_LOCAL=1 works only with a fake Bot API, set BOT_API_BASE_URL")
+
+        self.started_at = time.perf_counter()
+        self.logger = logging.getLogger("Bot")
+
         self.state: BotState = BotState.IDLE  # later it should be state per user or group, now its just global
 
         self.file_manager = FileManager(dir_path="files")
 
-        self.ngram_talk_module: NGramTalkModule = NGramTalkModule(n=3)
+        self.rng = random.Random(self.random_seed)
+
+        self.ngram_talk_module: NGramTalkModule = NGramTalkModule(n=3, seed=self.random_seed)
         if os.path.exists(self.file_manager(self.NGRAM_MODULE_SAVE_FILE_NAME)):
             with open(self.file_manager(self.NGRAM_MODULE_SAVE_FILE_NAME), encoding="utf-8") as file:
-                text = "\n".join(file.readlines())
+                text = file.read()
+            # only the merged table is decoded here, per text tables are decoded when they are needed
             self.ngram_talk_module.deserialize_from_text(text)
+            self.logger.info(f"Loaded ngram module in {self.ngram_talk_module.load_seconds:.2f} s")
         self.text_id: str = ""
 
-        self.santa_module = SantaModule()
-
-        self.app = ApplicationBuilder().token(self.token).build()
+        self.santa_store = SantaStore()
+        self.santa_group_id: str = ""
+
+        self.send_queue = SendQueue(global_rate=self.send_global_rate, per_chat_rate=self.send_per_chat_rate)
+
+        builder = (
+            ApplicationBuilder()
+            .token(self.token)
+            .post_init(self._post_init)
+            .post_stop(self._post_stop)
+            .concurrent_updates(self.concurrent_updates)
+        )
+        if self.bot_api_base_url:
+            builder = builder.base_url(self.bot_api_base_url)
+        self.app = builder.build()
         self.app.add_handler(MessageHandler(None, self.handle_update))
 
-        self.logger = logging.getLogger("Bot")
-
     def start(self):
-        self.app.run_polling()
+        if self.webhook_url or self.webhook_local:
+            self.start_webhook()
+        else:
+            self.app.run_polling()
+
+    def start_webhook(self):
+        """Telegram pushes updates to our local http server instead of us polling them"""
+        if self.webhook_local:
+            # there is no public url, PTB will register http://listen:port/path itself,
+            # which only a fake Bot API (BOT_API_BASE_URL) accepts
+            webhook_url = None
+        else:
+            webhook_url = self.webhook_url.rstrip("/") + "/" + self.WEBHOOK_URL_PATH
+
+        self.logger.info(f"Starting webhook on {self.webhook_listen}:{self.webhook_port}, url {webhook_url}")
+        self.app.run_webhook(
+            listen=self.webhook_listen,
+            port=self.webhook_port,
+            url_path=self.WEBHOOK_URL_PATH,
+            webhook_url=webhook_url,
+            secret_token=self.webhook_secret,
+        )
+
+    async def _post_init(self, app):
+        await self.send_queue.start()
+        self.logger.info(f"Ready to reply in {time.perf_counter() - self.started_at:.2f} s since start")
+
+    async def _post_stop(self, app):
+        await self.send_queue.stop()
 
     async def shutdown(self):
         """Saving some state before turning off"""
@@ -71,6 +125,49 @@ class Bot:
     def token(self) -> str:
         return os.getenv("BOT_TOKEN")
 
+    @property
+    def random_seed(self) -> str | None:
+        # set it to get the same replies between runs, e.g. for benchmarks
+        return os.getenv("RANDOM_SEED")
+
+    @property
+    def concurrent_updates(self) -> int:
+        # state is still global, so updates are processed one by one unless asked otherwise
+        return int(os.getenv("CONCURRENT_UPDATES", 1))
+
+    @property
+    def bot_api_base_url(self) -> str | None:
+        # e.g. http://localhost:8081/bot for the fake api from load_test.py
+        return os.getenv("BOT_API_BASE_URL")
+
+    @property
+    def send_global_rate(self) -> float:
+        return float(os.getenv("SEND_GLOBAL_RATE", GLOBAL_RATE))
+
+    @property
+    def send_per_chat_rate(self) -> float:
+        return float(os.getenv("SEND_PER_CHAT_RATE", PER_CHAT_RATE))
+
+    @property
+    def webhook_local(self) -> bool:
+        return os.getenv("WEBHOOK_LOCAL") == "1"
+
+    @property
+    def webhook_url(self) -> str | None:
+        return os.getenv("WEBHOOK_URL")
+
+    @property
+    def webhook_listen(self) -> str:
+        return os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+
+    @property
+    def webhook_port(self) -> int:
+        return int(os.getenv("WEBHOOK_PORT", 8443))
+
+    @property
+    def webhook_secret(self) -> str | None:
+        return os.getenv("WEBHOOK_SECRET")
+
     def is_admin(self, user: telegram.User):
         return user.id == int(os.getenv("ADMIN_ID"))
 
@@ -79,10 +176,31 @@ class Bot:
         chat_str = message.chat.type + ' ' + (message.chat.title or '') + ' ' + (str(message.chat.id) or '') + ' ' + (str(message.message_thread_id) or '')
         text_str = text if not hide_text else "<hidden>"
         self.logger.info(f"Sending message to user {user_str} in chat {chat_str}: '{text_str}' | {message.id}")
-        await message.reply_text(text)
+        await self.send_queue.put(message.chat_id, lambda: message.reply_text(text))
 
     async def send_message(self, *, chat_id: int, message_thread_id: int = None, text: str):
-        await self.app.bot.send_message(text=text, chat_id=chat_id, message_thread_id=message_thread_id)
+        await self.send_queue.put(
+            chat_id,
+            lambda: self.app.bot.send_message(text=text, chat_id=chat_id, message_thread_id=message_thread_id),
+        )
+
+    def _format_ngram_statistics(self) -> str:
+        stats = self.ngram_talk_module.get_statistics()
+
+        def format_table(table_stats) -> str:
+            orders = ", ".join(f"{order}: {cnt}" for order, cnt in table_stats.n_ngrams_by_order.items())
+            return (
+                f"n-граммы по порядку {{{orders}}}, переходов {table_stats.n_transitions}, "
+                f"слов {table_stats.n_tokens}, словарь {table_stats.vocabulary_size}, "
+                f"~{table_stats.estimated_bytes / 2 ** 20:.1f} МБ, {table_stats.seconds:.2f} с"
+            )
+
+        lines = [f"Всего: {format_table(stats.total)}"]
+        lines += [f"{text_id}: {format_table(table_stats)}" for text_id, table_stats in stats.per_text.items()]
+        lines.append("Самые тяжелые контексты: " + ", ".join(
+            f"'{' '.join(ngram)}' ({cnt})" for ngram, cnt in stats.top_contexts
+        ))
+        return "\n".join(lines)[:telegram.constants.MessageLimit.MAX_TEXT_LENGTH]
 
     async def handle_update(self, update: telegram.Update, context: ContextTypes.DEFAULT_TYPE):
         try:
@@ -111,20 +229,29 @@ class Bot:
 
             if self.state == BotState.LEARN_TEXT_WAITING_TEXT:
                 with open(saved_path, encoding="utf-8") as saved:
-                    self.ngram_talk_module.learn_text(self.text_id, '\n'.join(saved.readlines()))
+                    # model lock may be held by a worker thread, so waiting for it must not block the event loop
+                    await asyncio.to_thread(
+                        self.ngram_talk_module.learn_text, self.text_id, '\n'.join(saved.readlines())
+                    )
                     await self._reply(message, f'Текст сохранен как {self.text_id}')
                     self.state = BotState.IDLE
             elif self.state == BotState.HIDDEN_SANTA_WAITING_FILE:
                 with open(saved_path, encoding="utf-8") as saved:
-                    self.santa_module.initialize_from_str('\n'.join(saved.readlines()))
-                    await self._reply(message, f'Прочитал! {len(self.santa_module.usernames)} юзеров и {len(self.santa_module.forbidden_pairs)} пар')
+                    self.santa_store.initialize_group_from_str(self.santa_group_id, '\n'.join(saved.readlines()))
+                    group = self.santa_store.groups[self.santa_group_id]
+                    await self._reply(message, f'Прочитал! {len(group.usernames)} юзеров и {len(group.forbidden_pairs)} пар')
+                    self.state = BotState.IDLE
+            elif self.state == BotState.HIDDEN_SANTA_WAITING_CSV:
+                with open(saved_path, encoding="utf-8", newline="") as saved:
+                    n_groups = self.santa_store.ingest_csv(saved)
+                    await self._reply(message, f'Прочитал! {n_groups} групп')
                     self.state = BotState.IDLE
             else:
                 await self._reply(message, "Не ожидаю файл... мне пофиг на него")
             return
 
         if not message.text:
-            random_reaction = random.choice(
+            random_reaction = self.rng.choice(
                 [
                     telegram.constants.ReactionEmoji.EYES,
                     telegram.constants.ReactionEmoji.FACE_SCREAMING_IN_FEAR,
@@ -135,7 +262,7 @@ class Bot:
                     telegram.constants.ReactionEmoji.OK_HAND_SIGN,
                 ]
             )
-            await message.set_reaction(reaction=[random_reaction])
+            await self.send_queue.put(message.chat_id, lambda: message.set_reaction(reaction=[random_reaction]))
             return
 
         text = message.text
@@ -148,7 +275,8 @@ class Bot:
                 return
 
             _, chat_id, message_thread_id, text = text.split(maxsplit=3)
-            await self.send_message(chat_id=chat_id, message_thread_id=message_thread_id, text=text)
+            # ids have to be ints, otherwise send queue keys the same chat differently from replies
+            await self.send_message(chat_id=int(chat_id), message_thread_id=int(message_thread_id), text=text)
             return
 
         if text.startswith("/start"):
@@ -174,23 +302,54 @@ class Bot:
             )
             await self._reply(message, msg)
             return
+        elif text.startswith("/ngram_stats"):
+            if not self.is_admin(message.from_user):
+                await self._reply(message, "У тебя нет полномочий для этого!")
+                return
+            # may have to decode all per text tables. The thread only frees the event loop (send queue, webhook),
+            # with CONCURRENT_UPDATES=1 other updates still wait for this one
+            await self._reply(message, await asyncio.to_thread(self._format_ngram_statistics))
+            return
         elif text.startswith("/santa_init"):
             if not self.is_admin(message.from_user):
                 await self._reply(message, "У тебя нет полномочий для этого!")
                 return
+            self.santa_group_id = str(message.chat.id)
             self.state = BotState.HIDDEN_SANTA_WAITING_FILE
             await self._reply(message, f'Пришли текстовый файл с юзерами и запрещенными парами.')
             return
+        elif text.startswith("/santa_csv"):
+            if not self.is_admin(message.from_user):
+                await self._reply(message, "У тебя нет полномочий для этого!")
+                return
+            self.state = BotState.HIDDEN_SANTA_WAITING_CSV
+            await self._reply(message, f'Пришли csv файл со строками group_id,login или group_id,login1,login2.')
+            return
+        elif text.startswith("/santa_start_all"):
+            if not self.is_admin(message.from_user):
+                await self._reply(message, "У тебя нет полномочий для этого!")
+                return
+            seed = text.split(maxsplit=1)[1].strip() if len(text.split()) >= 2 else None
+            # thousands of groups take a while, the event loop has to keep sending and receiving meanwhile,
+            # worker processes would only add startup and pickling costs here
+            failed_group_ids = await asyncio.to_thread(
+                self.santa_store.generate_all_permutations, seed, max_workers=1
+            )
+            msg = f"Перестановки для {len(self.santa_store) - len(failed_group_ids)} групп сгенерированы! seed: '{seed}'"
+            if failed_group_ids:
+                msg += f"\nНе получилось для групп: {', '.join(failed_group_ids)}"
+            await self._reply(message, msg)
+            return
         elif text.startswith("/santa_start"):
             if not self.is_admin(message.from_user):
                 await self._reply(message, "У тебя нет полномочий для этого!")
                 return
             seed = text.split(maxsplit=1)[1].strip() if len(text.split()) >= 2 else None
-            self.santa_module.generate_permutation(seed)
+            self.santa_store.generate_permutation(str(message.chat.id), seed)
             await self._reply(message, f"Перестановка сгенерирована! Успехов! seed: '{seed}'")
             return
         elif text.startswith("/santa"):
-            text = self.santa_module.handle_message(message)
+            text = self.santa_store.handle_message(message)
             await self._reply(message, text, hide_text=True)
             return
 
@@ -202,11 +361,12 @@ class Bot:
             self.state = BotState.LEARN_TEXT_WAITING_TEXT
             await self._reply(message, f'Напиши сам текст или пришли его txt файлом.')
         elif self.state == BotState.LEARN_TEXT_WAITING_TEXT:
-            self.ngram_talk_module.learn_text(self.text_id, message.text)
+            await asyncio.to_thread(self.ngram_talk_module.learn_text, self.text_id, message.text)
             await self._reply(message, f'Текст сохранен как {self.text_id}')
             self.state = BotState.IDLE
         elif self.state == BotState.FORGET_TEXT_WAITING_TEXT_ID:
             text_id = message.text.split("\n")[0]
-            self.ngram_talk_module.forget_text(text_id)
+            # decodes the forgotten text, in a thread for the same reason as /ngram_stats
+            await asyncio.to_thread(self.ngram_talk_module.forget_text, text_id)
             self.state = BotState.IDLE
             await self._reply(message, f'Текст {text_id} удален')
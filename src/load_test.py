@@ -0,0 +1,191 @@
+"""
+Posts synthetic Telegram updates to the bot running in local webhook mode and measures
+how many updates per second it sustains, counting an update as processed when its reply reaches the fake Bot API.
+
+    python load_test.py --n-updates 5000 --concurrency 50 &
+    BOT_TOKEN=123:fake BOT_API_BASE_URL=http://localhost:8081/bot WEBHOOK_LOCAL=1 WEBHOOK_SECRET=secret \\
+        SEND_GLOBAL_RATE=100000 SEND_PER_CHAT_RATE=100000 python main.py
+
+The fake api has to be up before the bot starts, because the bot calls getMe and setWebhook on startup.
+"""
+import argparse
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import httpx
+
+
+REPLY_METHODS = {"sendmessage", "setmessagereaction"}
+
+
+class FakeBotApi(ThreadingHTTPServer):
+    """Answers Bot API calls like Telegram would and counts replies of the bot"""
+    daemon_threads = True
+
+    def __init__(self, host: str = "localhost", port: int = 8081, latency: float = 0.0):
+        super().__init__((host, port), FakeBotApiHandler)
+        self.latency = latency
+        self.calls: dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/bot"
+
+    @property
+    def n_replies(self) -> int:
+        with self.lock:
+            return sum(cnt for method, cnt in self.calls.items() if method in REPLY_METHODS)
+
+    def count_call(self, method: str):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+class FakeBotApiHandler(BaseHTTPRequestHandler):
+    server: FakeBotApi
+
+    def do_POST(self):
+        method = self.path.rsplit("/", 1)[-1].lower()
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+        params = {key: values[0] for key, values in parse_qs(body).items()}
+
+        time.sleep(self.server.latency)
+        self.server.count_call(method)
+
+        if method == "getme":
+            result = {"id": 1, "is_bot": True, "first_name": "Oleg", "username": "oleg_anglerfish_bot"}
+        elif method == "sendmessage":
+            chat_id = int(params.get("chat_id", 0))
+            result = {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text", ""),
+            }
+        else:
+            result = True
+
+        response = json.dumps({"ok": True, "result": result}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_update(update_id: int, n_chats: int, text: str) -> dict:
+    chat_id = 1_000_000 + update_id % n_chats
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Load", "username": f"load_{chat_id}"},
+            "text": text,
+        },
+    }
+
+
+async def wait_for_bot(api: FakeBotApi, url: str, timeout: float):
+    deadline = time.perf_counter() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.perf_counter() < deadline:
+            if api.calls.get("setwebhook"):
+                try:
+                    await client.get(url)
+                    return
+                except httpx.TransportError:
+                    pass
+            await asyncio.sleep(0.1)
+    raise TimeoutError(f"Bot didn't start webhook at {url} in {timeout} seconds")
+
+
+async def run_load_test(
+    api: FakeBotApi,
+    url: str,
+    n_updates: int,
+    concurrency: int,
+    n_chats: int = 100,
+    text: str = "Привет, как дела?",
+    secret: str | None = None,
+    timeout: float = 600,
+) -> dict[str, float]:
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    update_ids = iter(range(n_updates))
+    latencies: list[float] = []
+    n_errors = 0
+    n_replies_before = api.n_replies
+
+    async def worker(client: httpx.AsyncClient):
+        nonlocal n_errors
+        for update_id in update_ids:
+            start = time.perf_counter()
+            response = await client.post(url, json=make_update(update_id, n_chats, text), headers=headers)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                n_errors += 1
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*[worker(client) for _ in range(concurrency)])
+        ingest_elapsed = time.perf_counter() - start
+
+    # webhook answers as soon as the update is queued, so the bot is done only when all replies arrived
+    n_expected = n_updates - n_errors
+    deadline = start + timeout
+    while api.n_replies - n_replies_before < n_expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    processed_elapsed = time.perf_counter() - start
+    n_processed = api.n_replies - n_replies_before
+
+    latencies.sort()
+    return {
+        "processed_updates_per_second": n_processed / processed_elapsed,
+        "ingested_updates_per_second": n_updates / ingest_elapsed,
+        "ingest_latency_p50_ms": 1000 * latencies[len(latencies) // 2],
+        "ingest_latency_p99_ms": 1000 * latencies[int(len(latencies) * 0.99)],
+        "processed": n_processed,
+        "errors": n_errors,
+    }
+
+
+async def main(args: argparse.Namespace):
+    api = FakeBotApi(port=args.api_port, latency=args.api_latency)
+    api.start()
+    print(f"Fake Bot API is listening at {api.base_url}, waiting for the bot...")
+
+    await wait_for_bot(api, args.url, timeout=args.timeout)
+    results = await run_load_test(
+        api, args.url, args.n_updates, args.concurrency, args.n_chats, secret=args.secret, timeout=args.timeout
+    )
+    for key, value in results.items():
+        print(f"{key}: {value:.2f}")
+
+    api.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8443/telegram")
+    parser.add_argument("--secret", default="secret")
+    parser.add_argument("--api-port", type=int, default=8081)
+    parser.add_argument("--api-latency", type=float, default=0.0)
+    parser.add_argument("--n-updates", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--n-chats", type=int, default=100)
+    parser.add_argument("--timeout", type=float, default=600)
+
+    asyncio.run(main(parser.parse_args()))
@@ -1,2 +1,2 @@
 from .ngram_talk import NGramTalkModule
-from .hidden_santa import SantaModule
+from .hidden_santa import SantaModule, SantaStore
@@ -1,4 +1,8 @@
+import csv
+import multiprocessing
 import random
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable
 
 from telegram import Message
 
@@ -10,17 +14,19 @@ N_MAX_ATTEMPTS = 100
 
 def generate_permutation(
     names: list[str],
-    forbidden_pairs: list[tuple[str, str]] | None = None,
-    seed: str | None = None
+    forbidden_pairs: Iterable[tuple[str, str]] | None = None,
+    seed: str | None = None,
+    rng: random.Random | None = None,
 ) -> dict[str, str]:
-    random.seed(seed)
+    """Uses rng if given, otherwise a new one seeded with seed, so the global random state is never touched"""
+    if rng is None:
+        rng = random.Random(seed)
 
-    if forbidden_pairs is None:
-        forbidden_pairs = []
+    forbidden_pairs = set(forbidden_pairs) if forbidden_pairs is not None else set()
 
     for _ in range(N_MAX_ATTEMPTS):
         receivers = names[:]
-        random.shuffle(receivers)
+        rng.shuffle(receivers)
 
         permutation = dict()
         for sender, receiver in zip(names, receivers):
@@ -33,19 +39,19 @@ def generate_permutation(
 
         return permutation
     else:
-        raise StopIteration(f"Max {N_MAX_ATTEMPTS} attempts reached, couldn't generate permutation")
+        raise ValueError(f"Max {N_MAX_ATTEMPTS} attempts reached, couldn't generate permutation")
 
 
 class SantaModule(BaseModule):
     def __init__(self):
         super().__init__()
         self.usernames: list[str] | None = None
-        self.forbidden_pairs: list[tuple[str, str]] | None = None
+        self.forbidden_pairs: set[tuple[str, str]] | None = None
         self.permutation: dict[str, str] | None = None
 
-    def initialize(self, usernames: list[str], forbidden_pairs: list[tuple[str, str]] | None = None):
+    def initialize(self, usernames: list[str], forbidden_pairs: Iterable[tuple[str, str]] | None = None):
         self.usernames = usernames
-        self.forbidden_pairs = forbidden_pairs if forbidden_pairs is not None else []
+        self.forbidden_pairs = set(forbidden_pairs) if forbidden_pairs is not None else set()
         self.permutation = None
 
     def initialize_from_str(self, s: str):
@@ -54,24 +60,24 @@ class SantaModule(BaseModule):
         login1,login2
         login2,login1
         """
-        s = [t for t in s.replace(' ', '').split("\n") if len(t) > 0]
-        usernames = s[0].split(",")
+        lines = (line.replace(' ', '') for line in s.splitlines())
+        lines = [line for line in lines if line]
+        usernames = lines[0].split(",")
 
-        forbidden_pairs = []
-        if len(s) > 1:
-            for pair_str in s[1:]:
-                pair = pair_str.split(",")
-                if len(pair) != 2:
-                    raise KeyError(f"{pair_str} contains {len(pair)} logins, should be 2")
-                forbidden_pairs.append((pair[0], pair[1]))
+        forbidden_pairs = set()
+        for pair_str in lines[1:]:
+            pair = pair_str.split(",")
+            if len(pair) != 2:
+                raise KeyError(f"{pair_str} contains {len(pair)} logins, should be 2")
+            forbidden_pairs.add((pair[0], pair[1]))
 
         self.initialize(usernames, forbidden_pairs)
 
-    def generate_permutation(self, seed: str | None = None):
+    def generate_permutation(self, seed: str | None = None, rng: random.Random | None = None):
         if self.usernames is None:
             raise ValueError("Usernames list is not initialized")
 
-        self.permutation = generate_permutation(self.usernames, self.forbidden_pairs, seed)
+        self.permutation = generate_permutation(self.usernames, self.forbidden_pairs, seed, rng)
 
     def handle_message(self, message: Message) -> str:
         if self.permutation is None:
@@ -82,3 +88,131 @@ class SantaModule(BaseModule):
             return f"Your username {username} is not in permutation! Sorry about that ^^"
 
         return f"Ты, {username}, даришь подарок @{self.permutation[username]}! Такие дела."
+
+
+class SantaStore(BaseModule):
+    """Many independent Santa groups, group_id is usually str(chat.id)"""
+    def __init__(self):
+        super().__init__()
+        self.groups: dict[str, SantaModule] = {}
+        self.group_ids_by_username: dict[str, set[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self.groups)
+
+    def _add_group(self, group_id: str, group: SantaModule):
+        self.remove_group(group_id)
+        self.groups[group_id] = group
+        for username in group.usernames:
+            self.group_ids_by_username.setdefault(username, set()).add(group_id)
+
+    def remove_group(self, group_id: str):
+        group = self.groups.pop(group_id, None)
+        if group is None:
+            return
+        for username in group.usernames:
+            self.group_ids_by_username[username].discard(group_id)
+            if not self.group_ids_by_username[username]:
+                del self.group_ids_by_username[username]
+
+    def initialize_group(
+        self,
+        group_id: str,
+        usernames: list[str],
+        forbidden_pairs: Iterable[tuple[str, str]] | None = None,
+    ):
+        group = SantaModule()
+        group.initialize(usernames, forbidden_pairs)
+        self._add_group(group_id, group)
+
+    def initialize_group_from_str(self, group_id: str, s: str):
+        group = SantaModule()
+        group.initialize_from_str(s)
+        self._add_group(group_id, group)
+
+    def ingest_csv(self, lines: Iterable[str]) -> int:
+        """
+        Reads rows one by one, so the file doesn't have to fit in memory as a string:
+        group_id,login          -- login takes part in the group
+        group_id,login1,login2  -- login1 can't give a present to login2
+        Returns the number of groups read.
+        """
+        usernames: dict[str, dict[str, None]] = {}  # dict keeps order and drops duplicates
+        forbidden_pairs: dict[str, set[tuple[str, str]]] = {}
+
+        for row in csv.reader(lines):
+            row = [cell.strip() for cell in row]
+            if not row or not any(row):
+                continue
+
+            group_id, logins = row[0], row[1:]
+            if len(logins) == 1:
+                usernames.setdefault(group_id, {})[logins[0]] = None
+            elif len(logins) == 2:
+                forbidden_pairs.setdefault(group_id, set()).add((logins[0], logins[1]))
+            else:
+                raise KeyError(f"{','.join(row)} contains {len(logins)} logins, should be 1 or 2")
+
+        for group_id, group_usernames in usernames.items():
+            self.initialize_group(group_id, list(group_usernames), forbidden_pairs.get(group_id))
+
+        return len(usernames)
+
+    def generate_permutation(self, group_id: str, seed: str | None = None):
+        if group_id not in self.groups:
+            raise KeyError(f"There is no santa group '{group_id}'")
+
+        self.groups[group_id].generate_permutation(seed)
+
+    def generate_all_permutations(self, seed: str | None = None, max_workers: int | None = 1) -> list[str]:
+        """
+        Regenerates every group, in process by default or in max_workers worker processes.
+        With seed every group gets its own seed derived from it.
+        Groups that can't be permuted keep their old permutation, their ids are returned.
+        """
+        group_ids = list(self.groups.keys())
+        args = (
+            (
+                self.groups[group_id].usernames,
+                self.groups[group_id].forbidden_pairs,
+                f"{seed}:{group_id}" if seed is not None else None,
+            )
+            for group_id in group_ids
+        )
+
+        if max_workers == 1:
+            permutations = [_try_generate_permutation(arg) for arg in args]
+        else:
+            # spawn, because forking a process with running threads (e.g. the bot) can deadlock
+            mp_context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context) as executor:
+                permutations = list(executor.map(_try_generate_permutation, args, chunksize=64))
+
+        failed_group_ids = []
+        for group_id, permutation in zip(group_ids, permutations):
+            if permutation is None:
+                failed_group_ids.append(group_id)
+            else:
+                self.groups[group_id].permutation = permutation
+
+        return failed_group_ids
+
+    def handle_message(self, message: Message) -> str:
+        group = self.groups.get(str(message.chat.id))
+        if group is not None:
+            return group.handle_message(message)
+
+        # in private chat we don't know the group, so look for the user everywhere
+        username = message.from_user.username
+        group_ids = self.group_ids_by_username.get(username)
+        if not group_ids:
+            return f"Your username {username} is not in permutation! Sorry about that ^^"
+
+        return "\n".join(self.groups[group_id].handle_message(message) for group_id in group_ids)
+
+
+def _try_generate_permutation(args: tuple) -> dict[str, str] | None:
+    try:
+        return generate_permutation(*args)
+    except ValueError:
+        return None
@@ -1,7 +1,15 @@
 from collections import defaultdict
+from collections.abc import MutableMapping
+from dataclasses import dataclass
 from tqdm import tqdm
+import functools
+import heapq
 import random
 import json
+import sys
+import threading
+import time
+from typing import Callable, Iterator
 
 import nltk
 from telegram import Message
@@ -9,31 +17,274 @@ from telegram import Message
 from .base import BaseModule
 
 
+N_TOP_CONTEXTS = 10
+SERIALIZATION_VERSION = 2
+
+CountsTable = dict[tuple[str, ...], dict[str, int]]
+
+
+# hash, key and value pointers of a dict entry with the usual 2/3 load factor
+DICT_ENTRY_BYTES = 36
+EMPTY_DICT_BYTES = sys.getsizeof({})
+
+
+@dataclass
+class NGramTableStats:
+    n_ngrams_by_order: dict[int, int]
+    n_transitions: int  # distinct (ngram, next word) pairs
+    n_tokens: int  # sum of counts after unigrams, i.e. how many words were learnt in context
+    vocabulary_size: int
+    estimated_bytes: int
+    seconds: float = 0.0  # how long it took to learn or load the table
+
+    @staticmethod
+    def from_counts(counts: dict[tuple[str, ...], dict[str, int]], seconds: float = 0.0) -> "NGramTableStats":
+        return NGramTableTotals.from_counts(counts).to_stats(seconds)
+
+
+class NGramTableTotals:
+    """
+    Stats of a counts table that are updated with deltas while the table changes, so they never need a full pass.
+    Size is estimated from entry counts and word lengths instead of walking the table.
+    """
+    def __init__(self):
+        self.n_ngrams_by_order: dict[int, int] = defaultdict(int)
+        self.n_transitions = 0
+        self.n_tokens = 0
+        self.word_refs: dict[str, int] = {}  # how many ngrams and transitions use the word
+        self.estimated_bytes = 0
+
+    def _ref_word(self, word: str):
+        refs = self.word_refs.get(word, 0) + 1
+        self.word_refs[word] = refs
+        if refs == 1:
+            self.estimated_bytes += sys.getsizeof(word)
+
+    def _unref_word(self, word: str):
+        refs = self.word_refs[word] - 1
+        if refs == 0:
+            del self.word_refs[word]
+            self.estimated_bytes -= sys.getsizeof(word)
+        else:
+            self.word_refs[word] = refs
+
+    def add_ngram(self, ngram: tuple[str, ...]):
+        self.n_ngrams_by_order[len(ngram)] += 1
+        self.estimated_bytes += sys.getsizeof(ngram) + EMPTY_DICT_BYTES + DICT_ENTRY_BYTES
+        for word in ngram:
+            self._ref_word(word)
+
+    def remove_ngram(self, ngram: tuple[str, ...]):
+        self.n_ngrams_by_order[len(ngram)] -= 1
+        if self.n_ngrams_by_order[len(ngram)] == 0:
+            del self.n_ngrams_by_order[len(ngram)]
+        self.estimated_bytes -= sys.getsizeof(ngram) + EMPTY_DICT_BYTES + DICT_ENTRY_BYTES
+        for word in ngram:
+            self._unref_word(word)
+
+    def add_transition(self, next_word: str):
+        self.n_transitions += 1
+        self.estimated_bytes += DICT_ENTRY_BYTES
+        self._ref_word(next_word)
+
+    def remove_transition(self, next_word: str):
+        self.n_transitions -= 1
+        self.estimated_bytes -= DICT_ENTRY_BYTES
+        self._unref_word(next_word)
+
+    def add_count(self, ngram: tuple[str, ...], cnt: int):
+        if len(ngram) == 1:
+            self.n_tokens += cnt
+
+    @staticmethod
+    def from_counts(counts: dict[tuple[str, ...], dict[str, int]]) -> "NGramTableTotals":
+        totals = NGramTableTotals()
+        for ngram, next_word_counts in counts.items():
+            totals.add_ngram(ngram)
+            for next_word, cnt in next_word_counts.items():
+                totals.add_transition(next_word)
+                totals.add_count(ngram, cnt)
+        return totals
+
+    def to_stats(self, seconds: float = 0.0) -> NGramTableStats:
+        return NGramTableStats(
+            n_ngrams_by_order=dict(sorted(self.n_ngrams_by_order.items())),
+            n_transitions=self.n_transitions,
+            n_tokens=self.n_tokens,
+            vocabulary_size=len(self.word_refs),
+            estimated_bytes=self.estimated_bytes,
+            seconds=seconds,
+        )
+
+
+@dataclass
+class NGramModelStats:
+    total: NGramTableStats
+    per_text: dict[str, NGramTableStats]
+    top_contexts: list[tuple[tuple[str, ...], int]]  # contexts with the most distinct next words
+
+
+class LazyCountsPerText(MutableMapping):
+    """
+    Maps text_id to its counts table. Tables can be added still serialized,
+    they are decoded on first access, so startup doesn't pay for texts nobody asked about.
+    """
+    def __init__(self, decode: Callable[[str, str], CountsTable]):
+        self.decode = decode
+        self._tables: dict[str, CountsTable | str] = {}  # str means not decoded yet
+        self._lock = threading.Lock()
+
+    def set_serialized(self, text_id: str, serialized: str):
+        self._tables[text_id] = serialized
+
+    def get_serialized(self, text_id: str) -> str | None:
+        """Serialized table if it was never decoded, otherwise None"""
+        table = self._tables[text_id]
+        return table if isinstance(table, str) else None
+
+    def is_loaded(self, text_id: str) -> bool:
+        return not isinstance(self._tables[text_id], str)
+
+    def __getitem__(self, text_id: str) -> CountsTable:
+        table = self._tables[text_id]
+        if not isinstance(table, str):
+            return table
+
+        with self._lock:
+            table = self._tables[text_id]
+            if isinstance(table, str):
+                table = self.decode(text_id, table)
+                self._tables[text_id] = table
+        return table
+
+    def __setitem__(self, text_id: str, table: CountsTable):
+        self._tables[text_id] = table
+
+    def __delitem__(self, text_id: str):
+        del self._tables[text_id]
+
+    def __contains__(self, text_id) -> bool:
+        return text_id in self._tables
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self._tables))
+
+    def __len__(self) -> int:
+        return len(self._tables)
+
+
+def _locked(method):
+    """
+    Changes of the model are serialized, e.g. when learn_text and forget_text run in different worker threads.
+    Callers in the event loop should go through asyncio.to_thread, otherwise waiting for the lock blocks the loop.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 class NGramTalkModule(BaseModule):
-    def __init__(self, n: int):
+    def __init__(self, n: int, seed: str | int | None = None):
         super().__init__()
 
         nltk.download('punkt_tab')
         self.punkt_end_of_sentence = {".", "?", "!", "..."}
 
         self.ngrams_to_next_word_counts: dict[tuple[str, ...], dict[str, int]] = defaultdict(dict)
-        self.counts_per_text: dict[str, dict[tuple[str, ...], dict[str, int]]] = {}
+        self.counts_per_text: LazyCountsPerText = LazyCountsPerText(self._decode_counts_for_text)
         self.n = n
-
-    def _recalculate_counts(self):
-        self.ngrams_to_next_word_counts: dict[tuple[str, ...], dict[str, int]] = defaultdict(dict)
+        self.rng = random.Random(seed)
+        # replies are generated without it, they only read snapshots of the merged table
+        self.lock = threading.RLock()
+
+        # per text stats are calculated once, when the text is learnt or first asked about.
+        # Totals and top contexts are updated on every change of the model,
+        # None means they have to be calculated again on next request, e.g. after loading
+        self.seconds_per_text: dict[str, float] = {}
+        self.stats_per_text: dict[str, NGramTableStats] = {}
+        self._totals: NGramTableTotals | None = NGramTableTotals()
+        self._top_contexts: dict[tuple[str, ...], int] | None = {}  # ngram -> number of distinct next words
+        self._top_contexts_min: int = 0  # contexts with less next words can't get into the top
+        self.load_seconds: float = 0.0
+
+    def _invalidate_stats(self):
+        self._totals = None
+        self._top_contexts = None
+
+    def _update_top_contexts(self, ngram: tuple[str, ...], n_next_words: int):
+        top_contexts = self._top_contexts
+        if top_contexts is None:
+            return
+        if len(top_contexts) == N_TOP_CONTEXTS and n_next_words <= self._top_contexts_min:
+            return
+
+        if ngram not in top_contexts and len(top_contexts) == N_TOP_CONTEXTS:
+            del top_contexts[min(top_contexts, key=top_contexts.get)]
+        top_contexts[ngram] = n_next_words
+        self._top_contexts_min = min(top_contexts.values())
+
+    def _add_count(self, ngram: tuple[str, ...], next_word: str, cnt: int):
+        next_word_counts = self.ngrams_to_next_word_counts.get(ngram)
+        if next_word_counts is None:
+            next_word_counts = self.ngrams_to_next_word_counts[ngram] = {}
+            if self._totals is not None:
+                self._totals.add_ngram(ngram)
+
+        old_cnt = next_word_counts.get(next_word, 0)
+        next_word_counts[next_word] = old_cnt + cnt
+
+        if self._totals is not None:
+            self._totals.add_count(ngram, cnt)
+            if old_cnt == 0:
+                self._totals.add_transition(next_word)
+        if old_cnt == 0:
+            self._update_top_contexts(ngram, len(next_word_counts))
+
+    def _subtract_count(self, ngram: tuple[str, ...], next_word: str, cnt: int):
+        next_word_counts = self.ngrams_to_next_word_counts[ngram]
+        new_cnt = next_word_counts[next_word] - cnt
+        if self._totals is not None:
+            self._totals.add_count(ngram, -cnt)
+
+        if new_cnt > 0:
+            next_word_counts[next_word] = new_cnt
+            return
+
+        del next_word_counts[next_word]
+        if self._totals is not None:
+            self._totals.remove_transition(next_word)
+        if self._top_contexts is not None and ngram in self._top_contexts:
+            # some other context may be heavier now, it is found on next request
+            self._top_contexts = None
+
+        if not next_word_counts:
+            del self.ngrams_to_next_word_counts[ngram]
+            if self._totals is not None:
+                self._totals.remove_ngram(ngram)
+
+    def _merge_legacy_counts(self):
+        # old saves have no merged table, it is built from every text once on load
+        # replies may be generated meanwhile, so the table is swapped only when it is ready
+        ngrams_to_next_word_counts: dict[tuple[str, ...], dict[str, int]] = defaultdict(dict)
 
         for counts in self.counts_per_text.values():
             for ngram, next_word_counts in counts.items():
                 for next_word, cnt in next_word_counts.items():
-                    self.ngrams_to_next_word_counts[ngram][next_word] = (
-                        self.ngrams_to_next_word_counts[ngram].get(next_word, 0) + cnt
+                    ngrams_to_next_word_counts[ngram][next_word] = (
+                        ngrams_to_next_word_counts[ngram].get(next_word, 0) + cnt
                     )
 
+        self.ngrams_to_next_word_counts = ngrams_to_next_word_counts
+        self._invalidate_stats()
+
+    @_locked
     def learn_text(self, text_id: str, text: str):
         if text_id in self.counts_per_text:
             raise KeyError(f"Text_id {text_id} already exists")
 
+        start = time.perf_counter()
         counts_for_this_text: dict[tuple[str, ...], dict[str, int]] = defaultdict(dict)
 
         tokenized_text = nltk.word_tokenize(text)
@@ -45,9 +296,7 @@ class NGramTalkModule(BaseModule):
             for k in range(len(prev_words_list)):
                 ngram = tuple(prev_words_list[-k - 1:])
                 counts_for_this_text[ngram][next_word] = counts_for_this_text[ngram].get(next_word, 0) + 1
-                self.ngrams_to_next_word_counts[ngram][next_word] = (
-                    self.ngrams_to_next_word_counts[ngram].get(next_word, 0) + 1
-                )
+                self._add_count(ngram, next_word, 1)
 
             if len(prev_words_list) < self.n:
                 prev_words_list.append(next_word)
@@ -55,34 +304,68 @@ class NGramTalkModule(BaseModule):
                 prev_words_list = prev_words_list[1:] + [next_word]
 
         self.counts_per_text[text_id] = counts_for_this_text
+        self.seconds_per_text[text_id] = time.perf_counter() - start
 
+    @_locked
     def forget_text(self, text_id: str):
         if text_id not in self.counts_per_text:
             raise KeyError(f"There is not text with id 'f{text_id}'")
 
+        for ngram, next_word_counts in self.counts_per_text[text_id].items():
+            for next_word, cnt in next_word_counts.items():
+                self._subtract_count(ngram, next_word, cnt)
+
         del self.counts_per_text[text_id]
-        self._recalculate_counts()
+        self.seconds_per_text.pop(text_id, None)
+        self.stats_per_text.pop(text_id, None)
+
+    @_locked
+    def get_statistics(self) -> NGramModelStats:
+        for text_id, counts in self.counts_per_text.items():
+            if text_id not in self.stats_per_text:
+                self.stats_per_text[text_id] = NGramTableStats.from_counts(counts, self.seconds_per_text.get(text_id, 0.0))
+        if self._totals is None:
+            self._totals = NGramTableTotals.from_counts(self.ngrams_to_next_word_counts)
+        if self._top_contexts is None:
+            self._top_contexts = dict(heapq.nlargest(
+                N_TOP_CONTEXTS,
+                ((ngram, len(next_word_counts)) for ngram, next_word_counts in self.ngrams_to_next_word_counts.items()),
+                key=lambda item: item[1],
+            ))
+            self._top_contexts_min = min(self._top_contexts.values(), default=0)
+
+        return NGramModelStats(
+            total=self._totals.to_stats(seconds=self.load_seconds),
+            per_text=dict(self.stats_per_text),
+            top_contexts=sorted(self._top_contexts.items(), key=lambda item: item[1], reverse=True),
+        )
 
     def _generate_sentence_from_words_list(
         self,
         words: list[str],
         n_max_words: int,
+        rng: random.Random | None = None,
     ) -> list[str]:
+        if rng is None:
+            rng = self.rng
+
         sentence_words = [word.lower() for word in words]
         for _ in range(n_max_words):
+            # the table may be changed from another thread, so every lookup is done once and copied
             for k in range(self.n, 0, -1):
-                ngram = tuple(sentence_words[-k:])
-                if ngram in self.ngrams_to_next_word_counts:
+                next_word_counts = self.ngrams_to_next_word_counts.get(tuple(sentence_words[-k:]))
+                if next_word_counts:
                     break
             else:
-                ngram = (".",)
+                next_word_counts = self.ngrams_to_next_word_counts.get((".",))
 
-            if ngram not in self.ngrams_to_next_word_counts:
+            next_word_counts = list(next_word_counts.items()) if next_word_counts else []
+            if not next_word_counts:
                 break
 
-            words = list(self.ngrams_to_next_word_counts[ngram].keys())
-            counts = list(self.ngrams_to_next_word_counts[ngram].values())
-            next_word = random.sample(words, counts=counts, k=1)[0]
+            words = [word for word, _ in next_word_counts]
+            counts = [cnt for _, cnt in next_word_counts]
+            next_word = rng.sample(words, counts=counts, k=1)[0]
             sentence_words.append(next_word)
 
             if next_word in self.punkt_end_of_sentence:
@@ -93,12 +376,19 @@ class NGramTalkModule(BaseModule):
 
         return sentence_words
 
-    def generate_text(self, text: str, n_words_sentence_max: int = 20, n_last_words: int = 5):
+    def generate_text(
+        self,
+        text: str,
+        n_words_sentence_max: int = 20,
+        n_last_words: int = 5,
+        rng: random.Random | None = None,
+    ):
+        """Pass own rng to get reproducible replies or to generate from several threads without sharing self.rng"""
         last_words = [word for word in nltk.word_tokenize(text) if word.isalpha()][-n_last_words:]
 
         words = []
         for word in last_words:
-            sentence_words = self._generate_sentence_from_words_list([word], n_max_words=n_words_sentence_max)
+            sentence_words = self._generate_sentence_from_words_list([word], n_max_words=n_words_sentence_max, rng=rng)
             words += [sentence_words[0].capitalize()] + sentence_words[1:]
 
         text = " ".join(words)
@@ -112,26 +402,65 @@ class NGramTalkModule(BaseModule):
     def handle_message(self, message: Message):
         return self.generate_text(message.text)
 
+    @staticmethod
+    def _serialize_counts(counts: CountsTable) -> dict[str, dict[str, int]]:
+        return {NGramTalkModule.serialize_ngram(ngram): next_word_counts for ngram, next_word_counts in counts.items()}
+
+    @staticmethod
+    def _deserialize_counts(serialized: dict[str, dict[str, int]]) -> CountsTable:
+        return {NGramTalkModule.deserialize_ngram(ngram): next_word_counts for ngram, next_word_counts in serialized.items()}
+
+    def _decode_counts_for_text(self, text_id: str, serialized: str) -> CountsTable:
+        start = time.perf_counter()
+        counts = NGramTalkModule._deserialize_counts(json.loads(serialized))
+        self.seconds_per_text[text_id] = time.perf_counter() - start
+        return counts
+
+    @_locked
     def serialize_to_text(self) -> str:
-        counts_per_text_with_tuples_replaced = {
-            text_id: {
-                NGramTalkModule.serialize_ngram(ngram): counts
-                for ngram, counts in counts_for_text.items()
+        """
+        Merged table is saved next to per text tables, so that it is enough to start replying.
+        Per text tables are nested json strings: json.loads skips over them quickly and they are decoded on demand.
+        """
+        serialized_per_text = {}
+        for text_id in self.counts_per_text:
+            serialized = self.counts_per_text.get_serialized(text_id)
+            if serialized is None:
+                serialized = json.dumps(NGramTalkModule._serialize_counts(self.counts_per_text[text_id]))
+            serialized_per_text[text_id] = serialized
+
+        return json.dumps(
+            {
+                "version": SERIALIZATION_VERSION,
+                "merged": NGramTalkModule._serialize_counts(self.ngrams_to_next_word_counts),
+                "texts": serialized_per_text,
             }
-            for text_id, counts_for_text in self.counts_per_text.items()
-        }
-        return json.dumps(counts_per_text_with_tuples_replaced)
+        )
 
+    @_locked
     def deserialize_from_text(self, text: str):
-        counts_per_text_with_tuples_replaced = json.loads(text)
-        self.counts_per_text = {
-            text_id: {
-                NGramTalkModule.deserialize_ngram(serialized): counts
-                for serialized, counts in counts_for_text.items()
-            }
-            for text_id, counts_for_text in counts_per_text_with_tuples_replaced.items()
-        }
-        self._recalculate_counts()
+        start = time.perf_counter()
+        data = json.loads(text)
+        self.counts_per_text = LazyCountsPerText(self._decode_counts_for_text)
+        self.seconds_per_text = {}
+        self.stats_per_text = {}
+
+        if "version" in data:
+            if data["version"] != SERIALIZATION_VERSION:
+                raise ValueError(f"Unknown ngram save version {data['version']}, expected {SERIALIZATION_VERSION}")
+            for text_id, serialized in data["texts"].items():
+                self.counts_per_text.set_serialized(text_id, serialized)
+            self.ngrams_to_next_word_counts = defaultdict(dict, NGramTalkModule._deserialize_counts(data["merged"]))
+            self._invalidate_stats()
+        else:
+            # old format is just {text_id: table}, everything has to be decoded to build the merged table
+            for text_id, counts_for_text in data.items():
+                text_start = time.perf_counter()
+                self.counts_per_text[text_id] = NGramTalkModule._deserialize_counts(counts_for_text)
+                self.seconds_per_text[text_id] = time.perf_counter() - text_start
+            self._merge_legacy_counts()
+
+        self.load_seconds = time.perf_counter() - start
 
     @staticmethod
     def serialize_ngram(ngram: tuple[str, ...]) -> str:
@@ -142,18 +471,10 @@ class NGramTalkModule(BaseModule):
         words = []
         i = 0
         while i < len(serialized):
-            length = ""
-            while serialized[i] != "#":
-                length += serialized[i]
-                i += 1
-            length = int(length)
-
-            word = ""
-            i += 1
-            for _ in range(length):
-                word += serialized[i]
-                i += 1
-
-            words.append(word)
+            separator = serialized.index("#", i)
+            length = int(serialized[i:separator])
+
+            i = separator + 1 + length
+            words.append(serialized[separator + 1:i])
 
         return tuple(words)
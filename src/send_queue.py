@@ -0,0 +1,223 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import OrderedDict, deque
+from datetime import timedelta
+from typing import Awaitable, Callable, Hashable
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+
+
+# Telegram allows about 30 messages per second overall and about 1 message per second in a single chat
+GLOBAL_RATE: float = 30.0
+PER_CHAT_RATE: float = 1.0
+PER_CHAT_BURST: float = 3.0
+
+N_WORKERS = 8
+N_MAX_RETRIES = 3
+RETRY_DELAY = 1.0
+QUEUE_MAX_SIZE = 1000
+CHAT_QUEUE_MAX_SIZE = 100
+MAX_CHAT_BUCKETS = 10_000
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float | None = None, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.clock = clock
+
+        self.tokens = self.capacity
+        self.updated_at = clock()
+        self.paused_until = self.updated_at
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def pause(self, seconds: float):
+        """No tokens are given until seconds pass, e.g. when Telegram asks to retry later"""
+        self._refill()
+        self.tokens = 0.0
+        self.paused_until = max(self.paused_until, self.updated_at + seconds)
+
+    def try_acquire(self) -> float:
+        """Takes a token if there is one and returns 0, otherwise returns seconds to wait for the next token"""
+        self._refill()
+        if self.updated_at < self.paused_until:
+            return self.paused_until - self.updated_at
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        while (delay := self.try_acquire()) > 0:
+            await asyncio.sleep(delay)
+
+
+SendCallable = Callable[[], Awaitable[object]]
+
+
+class SendQueue:
+    """
+    Outbound messages go through this queue so that handlers don't wait for Telegram API.
+    Every chat has its own FIFO and at most one message in flight, so messages in a chat are sent in order.
+    Workers only take chats that have a token in their bucket, so a flooded chat never delays other chats.
+    Workers respect the global rate limit and retry on flood control and network errors.
+    """
+    def __init__(
+        self,
+        n_workers: int = N_WORKERS,
+        global_rate: float = GLOBAL_RATE,
+        per_chat_rate: float = PER_CHAT_RATE,
+        per_chat_burst: float = PER_CHAT_BURST,
+        n_max_retries: int = N_MAX_RETRIES,
+        retry_delay: float = RETRY_DELAY,
+        max_size: int = QUEUE_MAX_SIZE,
+        chat_queue_max_size: int = CHAT_QUEUE_MAX_SIZE,
+        max_chat_buckets: int = MAX_CHAT_BUCKETS,
+    ):
+        self.n_workers = n_workers
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.n_max_retries = n_max_retries
+        self.retry_delay = retry_delay
+        self.max_size = max_size
+        self.chat_queue_max_size = chat_queue_max_size
+        self.max_chat_buckets = max_chat_buckets
+
+        self.global_bucket = TokenBucket(global_rate)
+        # least recently used buckets are dropped, they are most likely full again anyway
+        self.chat_buckets: OrderedDict[Hashable, TokenBucket] = OrderedDict()
+
+        # chat is in chat_queues while it has queued or in flight messages,
+        # and in ready heap as (not before, order, chat_id) while it has queued messages and none in flight
+        self.chat_queues: dict[Hashable, deque[SendCallable]] = {}
+        self.ready: list[tuple[float, int, Hashable]] = []
+        self._order = itertools.count()
+        self.n_pending = 0  # queued and in flight messages
+
+        self._changed: asyncio.Condition | None = None
+        self.workers: list[asyncio.Task] = []
+
+        self.logger = logging.getLogger("SendQueue")
+
+    async def start(self):
+        # condition is created here so that it is bound to the running event loop
+        self._changed = asyncio.Condition()
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.n_workers)]
+
+    async def stop(self):
+        """Sends everything that is already queued and stops workers"""
+        if self._changed is None:
+            return
+
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.n_pending == 0)
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+
+        self.workers = []
+        self._changed = None
+
+    async def put(self, chat_id: Hashable, send: SendCallable):
+        """
+        Waits if the whole queue is full, so producers get backpressure.
+        If only this chat is flooded, the message is dropped instead, so one chat can't stop the bot.
+        """
+        if self._changed is None:
+            raise RuntimeError("Send queue is not started")
+
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.n_pending < self.max_size)
+
+            chat_queue = self.chat_queues.get(chat_id)
+            if chat_queue is None:
+                chat_queue = self.chat_queues[chat_id] = deque()
+                self._schedule(chat_id, 0.0)
+            elif len(chat_queue) >= self.chat_queue_max_size:
+                self.logger.warning(f"Too many messages queued for chat {chat_id}, dropping the new one")
+                return
+
+            chat_queue.append(send)
+            self.n_pending += 1
+            self._changed.notify_all()
+
+    def _schedule(self, chat_id: Hashable, delay: float):
+        heapq.heappush(self.ready, (time.monotonic() + delay, next(self._order), chat_id))
+
+    def _chat_bucket(self, chat_id: Hashable) -> TokenBucket:
+        if chat_id in self.chat_buckets:
+            self.chat_buckets.move_to_end(chat_id)
+        else:
+            self.chat_buckets[chat_id] = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+            if len(self.chat_buckets) > self.max_chat_buckets:
+                self.chat_buckets.popitem(last=False)
+        return self.chat_buckets[chat_id]
+
+    async def _next_chat(self) -> Hashable:
+        """Waits for a chat that has a queued message and a token in its bucket, the token is taken"""
+        async with self._changed:
+            while True:
+                if not self.ready:
+                    await self._changed.wait()
+                    continue
+
+                delay = self.ready[0][0] - time.monotonic()
+                if delay <= 0:
+                    _, _, chat_id = heapq.heappop(self.ready)
+                    delay = self._chat_bucket(chat_id).try_acquire()
+                    if delay == 0:
+                        return chat_id
+                    self._schedule(chat_id, delay)
+                    continue
+
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._next_chat()
+            send = self.chat_queues[chat_id].popleft()
+            try:
+                await self._send(chat_id, send)
+            except Exception as e:
+                self.logger.warning(f"Failed to send message to chat {chat_id}: {e}")
+            finally:
+                async with self._changed:
+                    self.n_pending -= 1
+                    if self.chat_queues[chat_id]:
+                        self._schedule(chat_id, 0.0)
+                    else:
+                        del self.chat_queues[chat_id]
+                    self._changed.notify_all()
+
+    async def _send(self, chat_id: Hashable, send: SendCallable):
+        for attempt in range(self.n_max_retries + 1):
+            await self.global_bucket.acquire()
+            try:
+                await send()
+                return
+            except RetryAfter as e:
+                if attempt == self.n_max_retries:
+                    raise
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                self.logger.info(f"Flood control for chat {chat_id}, pausing all sending for {retry_after} seconds")
+                # flood control is for the whole bot, so other workers have to wait too
+                self.global_bucket.pause(retry_after)
+            except (BadRequest, TimedOut):
+                # the request may have reached Telegram before timing out, retrying could send the message twice
+                raise
+            except NetworkError:
+                if attempt == self.n_max_retries:
+                    raise
+                await asyncio.sleep(self.retry_delay * 2 ** attempt)
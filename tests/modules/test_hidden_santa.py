@@ -1,6 +1,9 @@
+import random
+from types import SimpleNamespace
+
 import pytest
 
-from modules import SantaModule
+from modules import SantaModule, SantaStore
 
 
 @pytest.fixture()
@@ -78,7 +81,7 @@ def test_only_two_logins():
     assert permutation["2"] == "1"
 
     santa_module.initialize(["1", "2"], [("1", "2")])
-    with pytest.raises(StopIteration):
+    with pytest.raises(ValueError):
         santa_module.generate_permutation()
 
 
@@ -179,3 +182,119 @@ def test_equal_distribution__forbidden_pairs(santa_module):
             if receiver == sender or (sender, receiver) in santa_module.forbidden_pairs:
                 continue
             assert counts[sender][receiver] >= MIN_PROPORTION_COEF * expected_proportions[sender][receiver] * N_ATTEMPTS
+
+
+def assert_valid_permutation(group: SantaModule):
+    permutation = group.permutation
+    assert set(permutation.keys()) == set(group.usernames)
+    assert set(permutation.values()) == set(group.usernames)
+    for sender, receiver in permutation.items():
+        assert sender != receiver
+        assert (sender, receiver) not in group.forbidden_pairs
+
+
+def test_store_ingest_csv():
+    lines = [
+        "chat1,1",
+        "chat2,a",
+        "chat1,2",
+        "chat2,b",
+        "chat1,3",
+        "",
+        "chat1, 1, 2",
+        "chat1,1,2",
+        "chat2,a,b",
+    ]
+    store = SantaStore()
+    assert store.ingest_csv(lines) == 2
+
+    assert store.groups["chat1"].usernames == ["1", "2", "3"]
+    assert store.groups["chat1"].forbidden_pairs == {("1", "2")}
+    assert store.groups["chat2"].usernames == ["a", "b"]
+    assert store.groups["chat2"].forbidden_pairs == {("a", "b")}
+    assert store.group_ids_by_username["1"] == {"chat1"}
+
+
+def test_store_ingest_csv__bad_row():
+    store = SantaStore()
+    with pytest.raises(KeyError):
+        store.ingest_csv(["chat1,1,2,3"])
+
+
+def test_store_reinitialize_group_updates_index():
+    store = SantaStore()
+    store.initialize_group("chat1", ["1", "2"])
+    store.initialize_group("chat1", ["3", "4"])
+
+    assert "1" not in store.group_ids_by_username
+    assert store.group_ids_by_username["3"] == {"chat1"}
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_store_generate_all_permutations(max_workers):
+    n_groups = 2000
+    lines = []
+    for group_id in range(n_groups):
+        lines += [f"{group_id},{group_id}_{i}" for i in range(10)]
+        lines.append(f"{group_id},{group_id}_0,{group_id}_1")
+
+    store = SantaStore()
+    store.ingest_csv(lines)
+    assert len(store) == n_groups
+
+    store.generate_all_permutations(seed="omg", max_workers=max_workers)
+    for group in store.groups.values():
+        assert_valid_permutation(group)
+
+    expected = {group_id: group.permutation for group_id, group in store.groups.items()}
+    store.generate_all_permutations(seed="omg", max_workers=max_workers)
+    assert {group_id: group.permutation for group_id, group in store.groups.items()} == expected
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_store_generate_all_permutations__failed_groups(max_workers):
+    store = SantaStore()
+    store.initialize_group("ok", ["1", "2"])
+    store.initialize_group("alone", ["3"])
+    store.initialize_group("forbidden", ["4", "5"], [("4", "5")])
+
+    failed_group_ids = store.generate_all_permutations(max_workers=max_workers)
+
+    assert sorted(failed_group_ids) == ["alone", "forbidden"]
+    assert store.groups["ok"].permutation == {"1": "2", "2": "1"}
+    assert store.groups["alone"].permutation is None
+    assert store.groups["forbidden"].permutation is None
+
+
+def test_store_handle_message():
+    store = SantaStore()
+    store.initialize_group("100", ["1", "2"])
+    store.initialize_group("200", ["1", "3"])
+    store.generate_all_permutations(max_workers=1)
+
+    def message(chat_id: int, username: str):
+        return SimpleNamespace(chat=SimpleNamespace(id=chat_id), from_user=SimpleNamespace(username=username))
+
+    assert "@2" in store.handle_message(message(100, "1"))
+    assert "@2" not in store.handle_message(message(200, "1"))
+
+    private_reply = store.handle_message(message(1, "1"))
+    assert "@2" in private_reply and "@3" in private_reply
+    assert "not in permutation" in store.handle_message(message(1, "4"))
+
+
+def test_generate_permutation__does_not_touch_global_random(santa_module):
+    random.seed(42)
+    expected = random.random()
+
+    random.seed(42)
+    santa_module.generate_permutation("omg")
+    assert random.random() == expected
+
+
+def test_generate_permutation__rng(santa_module):
+    santa_module.generate_permutation(rng=random.Random("omg"))
+    permutation_from_rng = santa_module.permutation
+
+    santa_module.generate_permutation("omg")
+    assert santa_module.permutation == permutation_from_rng
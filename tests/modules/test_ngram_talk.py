@@ -1,6 +1,11 @@
+import json
+import random
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
 
 from modules import NGramTalkModule
+from modules.ngram_talk import NGramTableStats
 
 
 @pytest.fixture()
@@ -111,3 +116,163 @@ def test_serialize(ngram_module):
 def test_serialize_ngram():
     ngram = ("abc", "a#a", "a,a,a", '"aaa"', '"r#r"', "42", "#a")
     assert NGramTalkModule.deserialize_ngram(NGramTalkModule.serialize_ngram(ngram)) == ngram
+
+
+def test_statistics(ngram_module):
+    stats = ngram_module.get_statistics()
+
+    assert stats.total.n_ngrams_by_order == {1: 7, 2: 6}
+    assert stats.total.n_transitions == 15
+    assert stats.total.vocabulary_size == 7
+    assert stats.total.estimated_bytes > 0
+
+    assert stats.per_text.keys() == {"first", "second"}
+    assert stats.per_text["second"].n_ngrams_by_order == {1: 3, 2: 2}
+    assert stats.per_text["second"].n_tokens == 3
+
+    assert stats.top_contexts[0][1] == 2
+    assert {ngram for ngram, cnt in stats.top_contexts if cnt == 2} == {("я", "люблю"), ("люблю",)}
+
+
+def assert_statistics_match_full_recalculation(module: NGramTalkModule):
+    stats = module.get_statistics()
+    expected = NGramTableStats.from_counts(module.ngrams_to_next_word_counts, seconds=stats.total.seconds)
+    assert stats.total == expected
+
+    expected_top_counts = sorted((len(counts) for counts in module.ngrams_to_next_word_counts.values()), reverse=True)
+    assert [cnt for _, cnt in stats.top_contexts] == expected_top_counts[:len(stats.top_contexts)]
+
+
+def test_statistics_are_updated_incrementally(ngram_module):
+    assert_statistics_match_full_recalculation(ngram_module)
+
+    ngram_module.learn_text("third", "Кошки любят гулять. Я люблю спать!")
+    assert_statistics_match_full_recalculation(ngram_module)
+    assert ngram_module.get_statistics().per_text.keys() == {"first", "second", "third"}
+
+    ngram_module.forget_text("first")
+    assert_statistics_match_full_recalculation(ngram_module)
+    stats = ngram_module.get_statistics()
+    assert stats.per_text.keys() == {"second", "third"}
+
+    ngram_module.forget_text("third")
+    assert ngram_module.get_statistics().total.n_ngrams_by_order == {1: 3, 2: 2}
+
+
+def test_statistics_after_forget_without_tokenizer():
+    module = NGramTalkModule(n=2)
+    module.deserialize_from_text(OLD_FORMAT_SERIALIZED)
+    assert_statistics_match_full_recalculation(module)
+
+    module.forget_text("first")
+    assert_statistics_match_full_recalculation(module)
+    assert module.get_statistics().total.vocabulary_size == 2
+    assert module.get_statistics().top_contexts == [(("a",), 1)]
+
+
+def test_statistics_after_deserialize():
+    module = NGramTalkModule(n=2)
+    module.deserialize_from_text('{"text": {"1#a": {"b": 2, "c": 1}, "1#b": {"c": 1}, "1#a1#b": {"c": 1}}}')
+
+    stats = module.get_statistics()
+    assert stats.per_text["text"].n_ngrams_by_order == {1: 2, 2: 1}
+    assert stats.per_text["text"].n_tokens == 4
+    assert stats.total.vocabulary_size == 3
+    assert stats.total.seconds == module.load_seconds
+
+
+def test_generate_sentence__same_for_the_same_seed():
+    def generate_all(module: NGramTalkModule, seed: str) -> list[list[str]]:
+        rng = random.Random(seed)
+        return [module._generate_sentence_from_words_list(["a"], n_max_words=10, rng=rng) for _ in range(20)]
+
+    module = NGramTalkModule(n=2)
+    module.deserialize_from_text('{"text": {"1#a": {"b": 1, "c": 1}, "1#b": {"a": 1, ".": 1}, "1#c": {"a": 1, ".": 1}}}')
+
+    expected = generate_all(module, "omg")
+    assert generate_all(module, "omg") == expected
+    assert generate_all(module, "haha") != expected
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda _: generate_all(module, "omg"), range(8)))
+    assert all(result == expected for result in results)
+
+
+def test_module_seed():
+    text = '{"text": {"1#a": {"b": 1, "c": 1, "d": 1}}}'
+    first, second = NGramTalkModule(n=2, seed=42), NGramTalkModule(n=2, seed=42)
+    first.deserialize_from_text(text)
+    second.deserialize_from_text(text)
+
+    for _ in range(10):
+        assert first._generate_sentence_from_words_list(["a"], 1) == second._generate_sentence_from_words_list(["a"], 1)
+
+
+def test_deserialize_is_lazy(ngram_module):
+    serialized = ngram_module.serialize_to_text()
+    new_ngram_module = NGramTalkModule(n=ngram_module.n)
+    new_ngram_module.deserialize_from_text(serialized)
+
+    assert set(new_ngram_module.counts_per_text) == {"first", "second"}
+    assert not new_ngram_module.counts_per_text.is_loaded("first")
+    assert not new_ngram_module.counts_per_text.is_loaded("second")
+    assert_compare_counts(new_ngram_module.ngrams_to_next_word_counts, ngram_module.ngrams_to_next_word_counts)
+
+    # not decoded texts are saved as they are
+    assert new_ngram_module.serialize_to_text() == serialized
+
+    # only the forgotten text is decoded
+    new_ngram_module.forget_text("first")
+    assert not new_ngram_module.counts_per_text.is_loaded("second")
+    assert_compare_counts(new_ngram_module.ngrams_to_next_word_counts, ngram_module.counts_per_text["second"])
+
+
+OLD_FORMAT_SERIALIZED = '{"first": {"1#a": {"b": 2}, "1#b": {"c": 1}}, "second": {"1#a": {"c": 1}}}'
+
+
+def test_deserialize_old_format():
+    module = NGramTalkModule(n=2)
+    module.deserialize_from_text(OLD_FORMAT_SERIALIZED)
+
+    assert_compare_counts(module.ngrams_to_next_word_counts, {("a",): {"b": 2, "c": 1}, ("b",): {"c": 1}})
+    assert_compare_counts(module.counts_per_text["second"], {("a",): {"c": 1}})
+
+
+def test_deserialize_unknown_version():
+    module = NGramTalkModule(n=2)
+
+    with pytest.raises(ValueError):
+        module.deserialize_from_text('{"version": 3, "merged": {}, "texts": {}}')
+
+
+def test_lazy_text_statistics():
+    module = NGramTalkModule(n=2)
+    module.deserialize_from_text(OLD_FORMAT_SERIALIZED)
+    lazy_module = NGramTalkModule(n=2)
+    lazy_module.deserialize_from_text(module.serialize_to_text())
+
+    stats = lazy_module.get_statistics()
+    assert lazy_module.counts_per_text.is_loaded("first")
+    assert stats.per_text["first"].n_ngrams_by_order == {1: 2}
+    assert stats.total.n_transitions == 3
+    assert lazy_module.seconds_per_text.keys() == {"first", "second"}
+
+
+def test_forget_text_while_generating():
+    module = NGramTalkModule(n=2)
+    module.deserialize_from_text(
+        json.dumps({f"text{i}": {"1#a": {"b": 1, f"c{i}": 1}, "1#b": {"a": 1, ".": 1}} for i in range(50)})
+    )
+
+    def generate():
+        rng = random.Random(0)
+        for _ in range(200):
+            module._generate_sentence_from_words_list(["a"], n_max_words=10, rng=rng)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        generating = executor.submit(generate)
+        for i in range(50):
+            module.forget_text(f"text{i}")
+        generating.result()
+
+    assert len(module.ngrams_to_next_word_counts) == 0
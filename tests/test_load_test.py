@@ -0,0 +1,34 @@
+import asyncio
+
+import telegram
+
+from load_test import FakeBotApi, make_update
+
+
+def test_make_update_is_valid_telegram_update():
+    update = telegram.Update.de_json(make_update(42, n_chats=10, text="Привет!"), bot=None)
+
+    assert update.update_id == 42
+    assert update.message.text == "Привет!"
+    assert update.message.chat.id == update.message.from_user.id == 1_000_002
+
+
+def test_fake_bot_api_counts_replies():
+    api = FakeBotApi(port=0)
+    api.start()
+
+    async def main():
+        async with telegram.Bot("123:fake", base_url=api.base_url) as bot:
+            message = await bot.send_message(chat_id=42, text="Привет!")
+            await bot.set_message_reaction(chat_id=42, message_id=1, reaction=[telegram.constants.ReactionEmoji.FIRE])
+        return message
+
+    try:
+        message = asyncio.run(main())
+    finally:
+        api.shutdown()
+
+    assert message.chat.id == 42
+    assert message.text == "Привет!"
+    assert api.calls["getme"] == 1
+    assert api.n_replies == 2
@@ -0,0 +1,217 @@
+import asyncio
+import time
+
+import pytest
+from telegram.error import BadRequest, RetryAfter, TimedOut
+
+from send_queue import SendQueue, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class FakeBotApi:
+    """Pretends to be Telegram: answers with some latency and can throw flood control errors"""
+    def __init__(self, latency: float = 0.0, n_flood_errors: int = 0):
+        self.latency = latency
+        self.n_flood_errors = n_flood_errors
+        self.sent: list[tuple[int, str]] = []
+
+    async def send_message(self, chat_id: int, text: str):
+        await asyncio.sleep(self.latency)
+        if self.n_flood_errors > 0:
+            self.n_flood_errors -= 1
+            raise RetryAfter(0)
+        self.sent.append((chat_id, text))
+
+
+def run_queue(api: FakeBotApi, messages: list[tuple[int, str]], **queue_kwargs) -> float:
+    async def main():
+        queue = SendQueue(**queue_kwargs)
+        await queue.start()
+        start = time.perf_counter()
+        for chat_id, text in messages:
+            await queue.put(chat_id, lambda chat_id=chat_id, text=text: api.send_message(chat_id, text))
+        await queue.stop()
+        return time.perf_counter() - start
+
+    return asyncio.run(main())
+
+
+def test_token_bucket():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, capacity=2, clock=clock)
+
+    assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() == pytest.approx(0.5)
+
+    clock.now = 0.5
+    assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() == pytest.approx(0.5)
+
+    clock.now = 100
+    assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() > 0
+
+
+def test_send_queue_sends_everything():
+    api = FakeBotApi(latency=0.001)
+    messages = [(chat_id, f"message {i}") for i in range(10) for chat_id in range(50)]
+
+    run_queue(api, messages, global_rate=10_000, per_chat_rate=10_000, per_chat_burst=10_000)
+
+    assert sorted(api.sent) == sorted(messages)
+
+
+def test_send_queue_retry_after():
+    api = FakeBotApi(n_flood_errors=2)
+
+    run_queue(api, [(1, "hi")], n_max_retries=3)
+
+    assert api.sent == [(1, "hi")]
+
+
+def test_send_queue_gives_up_after_retries():
+    api = FakeBotApi(n_flood_errors=10)
+
+    run_queue(api, [(1, "hi")], n_max_retries=2)
+
+    assert api.sent == []
+    assert api.n_flood_errors == 7
+
+
+def test_send_queue_does_not_retry_bad_request():
+    n_calls = 0
+
+    async def send():
+        nonlocal n_calls
+        n_calls += 1
+        raise BadRequest("Message text is empty")
+
+    async def main():
+        queue = SendQueue(n_max_retries=3)
+        await queue.start()
+        await queue.put(1, send)
+        await queue.stop()
+
+    asyncio.run(main())
+    assert n_calls == 1
+
+
+def test_send_queue_per_chat_rate_limit():
+    api = FakeBotApi()
+    messages = [(1, str(i)) for i in range(6)]
+
+    elapsed = run_queue(api, messages, per_chat_rate=20, per_chat_burst=1)
+
+    assert len(api.sent) == len(messages)
+    assert elapsed >= 0.8 * (len(messages) - 1) / 20
+
+
+def test_send_queue_keeps_order_in_chat():
+    sent = []
+    n_flood_errors = 1
+
+    async def send(i: int):
+        nonlocal n_flood_errors
+        await asyncio.sleep(0.01)
+        if i == 0 and n_flood_errors > 0:
+            n_flood_errors -= 1
+            raise RetryAfter(0)
+        sent.append(i)
+
+    async def main():
+        queue = SendQueue(per_chat_rate=10_000, per_chat_burst=10_000, global_rate=10_000)
+        await queue.start()
+        for i in range(3):
+            await queue.put(1, lambda i=i: send(i))
+        await queue.stop()
+
+    asyncio.run(main())
+    assert sent == [0, 1, 2]
+
+
+def test_token_bucket_pause():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=10, capacity=10, clock=clock)
+
+    bucket.pause(5)
+    assert bucket.try_acquire() == pytest.approx(5)
+
+    clock.now = 4
+    assert bucket.try_acquire() == pytest.approx(1)
+
+    clock.now = 5
+    assert bucket.try_acquire() == 0
+
+
+def test_chat_buckets_are_bounded():
+    queue = SendQueue(max_chat_buckets=2)
+
+    queue._chat_bucket(1)
+    queue._chat_bucket(2)
+    queue._chat_bucket(1)
+    queue._chat_bucket(3)
+
+    assert list(queue.chat_buckets.keys()) == [1, 3]
+
+
+def test_flooded_chat_does_not_delay_other_chats():
+    sent_at: dict[int, list[float]] = {1: [], 2: []}
+
+    async def send(chat_id: int):
+        sent_at[chat_id].append(time.perf_counter())
+
+    async def main():
+        # a single worker, so both chats are served by it
+        queue = SendQueue(n_workers=1, global_rate=10_000, per_chat_rate=1, per_chat_burst=1)
+        await queue.start()
+        start = time.perf_counter()
+        for _ in range(5):
+            await queue.put(1, lambda: send(1))
+        await queue.put(2, lambda: send(2))
+        await asyncio.sleep(0.1)
+        for worker in queue.workers:
+            worker.cancel()
+        return start
+
+    start = asyncio.run(main())
+    assert len(sent_at[1]) == 1
+    assert len(sent_at[2]) == 1
+    assert sent_at[2][0] - start < 0.1
+
+
+def test_send_queue_drops_messages_of_flooded_chat():
+    api = FakeBotApi()
+    messages = [(1, str(i)) for i in range(5)] + [(2, "hi")]
+
+    run_queue(api, messages, chat_queue_max_size=2, per_chat_rate=10_000, per_chat_burst=10_000)
+
+    # first message may already be in flight, so 2 or 3 of 5 messages get through
+    assert 2 <= len([chat_id for chat_id, _ in api.sent if chat_id == 1]) <= 3
+    assert (2, "hi") in api.sent
+
+
+def test_send_queue_does_not_retry_timed_out():
+    n_calls = 0
+
+    async def send():
+        nonlocal n_calls
+        n_calls += 1
+        raise TimedOut()
+
+    async def main():
+        queue = SendQueue(n_max_retries=3, retry_delay=0)
+        await queue.start()
+        await queue.put(1, send)
+        await queue.stop()
+
+    asyncio.run(main())
+    assert n_calls == 1